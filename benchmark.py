@@ -0,0 +1,318 @@
+import argparse
+import json
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from sys import argv
+
+from launcher import generate_single_config_file
+
+FORMAT = 'utf-8'
+HOST = 'localhost'  # local
+HERE = Path(__file__).resolve().parent
+
+
+def parse_args(args):
+    """
+    Return the benchmark settings from the command line.
+    """
+    parser = argparse.ArgumentParser(description='Load test the root, TLD and auth servers.')
+    parser.add_argument('--tlds', type=int, default=3, help='number of top level domains')
+    parser.add_argument('--domains', type=int, default=10, help='domains under each top level domain')
+    parser.add_argument('--hosts', type=int, default=100, help='hostnames under each domain')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients sending raw lookups')
+    parser.add_argument('--resolvers', type=int, default=4, help='concurrent recursor.py processes')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds each phase runs for')
+    parser.add_argument('--timeout', type=float, default=5.0, help='timeout of a single lookup')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic master')
+    parser.add_argument('--output', default='benchmark.json', help='where to write the JSON report')
+    parser.add_argument('--baseline', help='earlier JSON report to compare against')
+    return parser.parse_args(args)
+
+
+def generate_master(tlds: int, domains: int, hosts: int, seed: int) -> dict:
+    """
+    Return a synthetic master record of tlds * domains * hosts hostnames.
+    """
+    rng = random.Random(seed)
+    record = {}
+    for t in range(tlds):
+        for d in range(domains):
+            # domain labels are unique across TLDs because auth files are named after them
+            for h in range(hosts):
+                record[f'h{h}.d{t}x{d}.t{t}'] = rng.randint(1024, 65535)
+    return record
+
+
+def free_port() -> int:
+    """
+    Return a local port nobody is listening on right now.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def read_config(path: Path):
+    # return the port of the server and the names it answers for
+    with open(path, 'r') as f_obj:
+        port_of_server = int(f_obj.readline().strip())
+        names = [line.split(',')[0].strip() for line in f_obj if line.strip()]
+    return port_of_server, names
+
+
+def rss_kb(pid: int):
+    # resident set size of a process in kB, or None where /proc is not available
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f_obj:
+            for line in f_obj:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+    return None
+
+
+def wait_until_listening(port: int, deadline: float) -> bool:
+    # poll the port until the server accepts a connection
+    while time.perf_counter() < deadline:
+        try:
+            with socket.create_connection((HOST, port), timeout=0.1):
+                return True
+        except OSError:
+            time.sleep(0.005)
+    return False
+
+
+def start_servers(single_files_dir_path: Path, timeout: float) -> list[dict]:
+    """
+    Start one server.py for every configuration file, each only once the one before it listens.
+    Starting them one at a time keeps the startup time of a server from including the others'.
+    """
+    servers = []
+    for path in sorted(single_files_dir_path.iterdir()):
+        port_of_server, names = read_config(path)
+        role = 'root' if path.name.startswith('root') else path.name.split('-')[0]
+        started = time.perf_counter()
+        # every client of the benchmark shares 127.0.0.1, so per-address rate limits would cap the load it measures
+        process = subprocess.Popen([sys.executable, str(HERE / 'server.py'), str(path),
+                                    '--rate', '0', '--write-rate', '0'],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        servers.append({'role': role, 'port': port_of_server, 'names': names, 'process': process})
+        if not wait_until_listening(port_of_server, started + timeout):
+            stop_servers(servers)
+            raise RuntimeError(f'{role} server on port {port_of_server} did not start')
+        servers[-1]['startup'] = time.perf_counter() - started
+    return servers
+
+
+def stop_servers(servers: list[dict]):
+    for server in servers:
+        server['process'].terminate()
+    for server in servers:
+        server['process'].wait()
+
+
+def lookup(port: int, name: str, timeout: float) -> bool:
+    # one raw query against one server, the way recursor.py sends it
+    with socket.create_connection((HOST, port), timeout=timeout) as sock:
+        sock.sendall(f'{name}\n'.encode(FORMAT))
+        response = sock.recv(1024).decode(FORMAT)
+    return response.endswith('\n') and response != 'NXDOMAIN\n'
+
+
+def percentile(sorted_values: list[float], fraction: float):
+    # nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarise(latencies: list[float], errors: int, elapsed: float) -> dict:
+    latencies.sort()
+    to_ms = (lambda value: None if value is None else round(value * 1000, 3))
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'qps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': to_ms(percentile(latencies, 0.50)),
+        'p99_ms': to_ms(percentile(latencies, 0.99)),
+        'p999_ms': to_ms(percentile(latencies, 0.999)),
+    }
+
+
+def run_clients(clients: int, duration: float, one_request) -> dict:
+    """
+    Call one_request(rng) from many threads until duration runs out.
+    one_request returns whether the answer was the expected one; only those count towards qps and latency.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(seed: int):
+        rng = random.Random(seed)
+        own_latencies = []
+        own_errors = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                ok = one_request(rng)
+            except (OSError, ValueError):
+                ok = False
+            if ok:
+                own_latencies.append(time.perf_counter() - started)
+            else:
+                own_errors += 1
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarise(latencies, errors[0], time.perf_counter() - started)
+
+
+def run_raw_lookups(servers: list[dict], settings) -> dict:
+    # every request picks a random server and a random name that server answers for
+    targets = [(server['port'], server['names']) for server in servers if server['names']]
+
+    def one_request(rng):
+        port, names = rng.choice(targets)
+        return lookup(port, rng.choice(names), settings.timeout)
+
+    return run_clients(settings.clients, settings.duration, one_request)
+
+
+def run_resolutions(root_port: int, hostnames: list[str], settings) -> dict:
+    # every client owns one recursor.py and feeds it one hostname at a time
+    resolvers = [subprocess.Popen([sys.executable, '-u', str(HERE / 'recursor.py'),
+                                   str(root_port), str(settings.timeout)],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                 for _ in range(settings.resolvers)]
+    free = list(resolvers)
+    lock = threading.Lock()
+
+    def one_request(rng):
+        with lock:
+            resolver = free.pop()
+        try:
+            resolver.stdin.write(rng.choice(hostnames) + '\n')
+            resolver.stdin.flush()
+            answer = resolver.stdout.readline().strip()
+        finally:
+            with lock:
+                free.append(resolver)
+        return answer.isdigit()
+
+    try:
+        return run_clients(settings.resolvers, settings.duration, one_request)
+    finally:
+        for resolver in resolvers:
+            resolver.stdin.close()
+            resolver.wait()
+
+
+def collect_memory(servers: list[dict]) -> dict:
+    memory = {}
+    for server in servers:
+        rss = rss_kb(server['process'].pid)
+        if rss is None:
+            continue
+        role = memory.setdefault(server['role'], {'servers': 0, 'total_kb': 0, 'max_kb': 0})
+        role['servers'] += 1
+        role['total_kb'] += rss
+        role['max_kb'] = max(role['max_kb'], rss)
+    return memory
+
+
+def collect_startup(servers: list[dict]) -> dict:
+    startup = {}
+    for server in servers:
+        startup.setdefault(server['role'], []).append(server['startup'])
+    return {role: {'mean_ms': round(sum(times) / len(times) * 1000, 3),
+                   'max_ms': round(max(times) * 1000, 3)}
+            for role, times in startup.items()}
+
+
+def flatten(report: dict, prefix='') -> dict:
+    # {'raw': {'qps': 1}} -> {'raw.qps': 1}, keeping only numbers
+    values = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f'{prefix}{key}'] = value
+    return values
+
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    """
+    Return one line for every metric found in both reports, with the relative change.
+    """
+    current, previous = flatten(report['results']), flatten(baseline['results'])
+    lines = []
+    for metric in sorted(current.keys() & previous.keys()):
+        before, after = previous[metric], current[metric]
+        change = f'{(after - before) / before * 100:+.1f}%' if before else 'n/a'
+        lines.append(f'{metric:40} {before:>12} {after:>12} {change:>9}')
+    return lines
+
+
+def main(args: list[str]) -> None:
+    settings = parse_args(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 1. Generate the master and the single configuration files with launcher.py
+        record = generate_master(settings.tlds, settings.domains, settings.hosts, settings.seed)
+        root_port = free_port()
+        single_files_dir_path = Path(tmp)
+        generate_single_config_file(str(single_files_dir_path), record, root_port, port_allocator=free_port)
+
+        # 2. Start every server and drive them
+        servers = start_servers(single_files_dir_path, settings.timeout)
+        try:
+            idle_memory = collect_memory(servers)
+            raw = run_raw_lookups(servers, settings)
+            resolutions = run_resolutions(root_port, list(record), settings)
+            loaded_memory = collect_memory(servers)
+        finally:
+            stop_servers(servers)
+
+    report = {
+        'settings': {key: value for key, value in vars(settings).items() if key not in ('output', 'baseline')},
+        'python': sys.version.split()[0],
+        'results': {
+            'servers': len(servers),
+            'records': len(record),
+            'startup': collect_startup(servers),
+            'rss_idle': idle_memory,
+            'rss_loaded': loaded_memory,
+            'raw': raw,
+            'recursor': resolutions,
+        },
+    }
+    with open(settings.output, 'w') as f_obj:
+        json.dump(report, f_obj, indent=2)
+    print(json.dumps(report['results'], indent=2))
+
+    if settings.baseline:
+        with open(settings.baseline, 'r') as f_obj:
+            baseline = json.load(f_obj)
+        print(f"{'metric':40} {'baseline':>12} {'current':>12} {'change':>9}")
+        print('\n'.join(compare(report, baseline)))
+
+
+if __name__ == "__main__":
+    main(argv[1:])
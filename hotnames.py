@@ -0,0 +1,136 @@
+from array import array
+from collections import OrderedDict
+
+CACHE_POLICIES = ('lru', 'lfu')
+
+
+class CountMinSketch:
+    """
+    Estimate how often each name was looked up in a fixed amount of memory.
+    Estimates never undercount; counters are halved every sample lookups so old traffic fades away.
+    """
+
+    def __init__(self, width: int, depth: int, sample=None):
+        self.width = max(1, width)
+        self.depth = max(1, depth)
+        self.rows = [array('I', bytes(4 * self.width)) for _ in range(self.depth)]
+        self.sample = sample or 10 * self.width
+        self.additions = 0
+
+    def indexes(self, name: str):
+        # one column per row from two hashes of the name
+        first, second = hash(name), hash((name, 1)) | 1
+        return [(first + row * second) % self.width for row in range(self.depth)]
+
+    def add(self, name: str) -> int:
+        # count one more lookup of name and return its new estimate
+        estimate = None
+        for row, index in zip(self.rows, self.indexes(name)):
+            row[index] += 1
+            estimate = row[index] if estimate is None else min(estimate, row[index])
+        self.additions += 1
+        if self.additions >= self.sample:
+            self.age()
+        return estimate
+
+    def estimate(self, name: str) -> int:
+        return min(row[index] for row, index in zip(self.rows, self.indexes(name)))
+
+    def age(self):
+        for row in self.rows:
+            for index in range(self.width):
+                row[index] >>= 1
+        self.additions = 0
+
+
+class HotNames:
+    """
+    Track the most looked up names with a count-min sketch and keep ready-made responses for the hot ones.
+    The cache sits in front of whatever the record is stored in and must be told about every change to it.
+    """
+
+    def __init__(self, cache_size: int, policy: str, min_hits: int, top_k: int, width: int, depth: int):
+        self.sketch = CountMinSketch(width, depth)
+        self.cache_size = cache_size
+        self.policy = policy
+        self.min_hits = min_hits
+        self.top_k = top_k
+        # name -> (response, response encoded), least recently used first
+        self.cache = OrderedDict()
+        # name -> estimate of a cached name when it was last looked up, lfu evicts the lowest
+        self.cached_lookups = {}
+        # name -> estimate of the top_k hottest names seen so far
+        self.top = {}
+        self.coldest = None
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, name: str):
+        """
+        Count a lookup of name and return its cached (response, encoded response), or None.
+        """
+        estimate = self.sketch.add(name)
+        if self.sketch.additions == 0:
+            # the sketch has just been aged, so age the estimate and the top names the same way
+            estimate >>= 1
+            self.top = {hot: count >> 1 for hot, count in self.top.items() if count >> 1}
+            self.cached_lookups = {hot: count >> 1 for hot, count in self.cached_lookups.items()}
+            self.coldest = min(self.top, key=self.top.get) if self.top else None
+        self.track(name, estimate)
+
+        entry = self.cache.get(name)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(name)
+        self.cached_lookups[name] = estimate
+        return entry
+
+    def track(self, name: str, estimate: int):
+        # keep the top_k names with the highest estimates
+        if not self.top_k:
+            return
+        if name in self.top or len(self.top) < self.top_k:
+            self.top[name] = estimate
+            if name == self.coldest or self.coldest not in self.top:
+                self.coldest = min(self.top, key=self.top.get)
+            elif estimate < self.top[self.coldest]:
+                self.coldest = name
+            return
+        if estimate > self.top[self.coldest]:
+            del self.top[self.coldest]
+            self.top[name] = estimate
+            self.coldest = min(self.top, key=self.top.get)
+
+    def offer(self, name: str, response: str, encoded: bytes):
+        """
+        Cache the response of name if it is hot enough.
+        lru evicts the least recently used name; lfu evicts the least looked up one, and only for a name looked up more.
+        """
+        estimate = self.sketch.estimate(name)
+        if not self.cache_size or estimate < self.min_hits:
+            return
+        if len(self.cache) >= self.cache_size:
+            if self.policy == 'lfu':
+                victim = min(self.cached_lookups, key=self.cached_lookups.get)
+                if self.cached_lookups[victim] >= estimate:
+                    return
+            else:
+                victim = next(iter(self.cache))
+            del self.cache[victim]
+            del self.cached_lookups[victim]
+        self.cache[name] = (response, encoded)
+        self.cached_lookups[name] = estimate
+
+    def invalidate(self, name=None):
+        # forget the cached response of name, or of every name
+        if name is None:
+            self.cache.clear()
+            self.cached_lookups.clear()
+        else:
+            self.cache.pop(name, None)
+            self.cached_lookups.pop(name, None)
+
+    def hottest(self, k: int) -> list[tuple[str, int]]:
+        return sorted(self.top.items(), key=lambda item: (-item[1], item[0]))[:k]
@@ -139,7 +139,11 @@ def generate_random_port() -> int:
     return random.randint(1024, 65535)  # valid port in this range
 
 
-def generate_single_config_file(single_files_dir_path: str, record, root_port):
+def generate_single_config_file(single_files_dir_path: str, record, root_port, port_allocator=generate_random_port):
+    """
+    Write root, tld and auth configuration files for the record.
+    port_allocator is called for the port of every TLD and authoritative server.
+    """
     # Validate directory path
     if not validate_directory_path(single_files_dir_path):
         return False
@@ -153,11 +157,11 @@ def generate_single_config_file(single_files_dir_path: str, record, root_port):
         subdomain, domain, tld = separate_domain(full_domain)
         if tld not in dict_top_level_domains:
             # hold that tld name in a dictionary and create a random port for that tld name like com, 3223
-            dict_top_level_domains[tld] = generate_random_port()
+            dict_top_level_domains[tld] = port_allocator()
         domain_name = f"{domain}.{tld}"
         if domain_name not in domains:
             # hold that domain name into dictionary by getting a new random port
-            domains[domain_name] = generate_random_port()
+            domains[domain_name] = port_allocator()
 
     # Write the root-conf file
     file_root = Path(single_files_dir_path).joinpath("root-conf")
@@ -0,0 +1,388 @@
+import errno
+import random
+import selectors
+import socket
+from collections import deque
+from itertools import islice
+
+FORMAT = 'utf-8'
+
+# bytes of a snapshot queued for a secondary at a time
+SNAPSHOT_CHUNK = 65536
+# records written to the queue of a secondary per refill of a snapshot
+SNAPSHOT_BATCH = 1024
+# bytes a secondary may send before its SYNC line is complete
+MAX_SYNC_LINE = 256
+# heartbeats a secondary may miss before it takes the link for dead and reconnects
+MISSED_HEARTBEATS = 3
+
+# Replication protocol, one line per message.
+# secondary -> primary:  SYNC <epoch> <seq>          the last change the secondary applied, epoch '-' if none
+# primary -> secondary:  SNAPSHOT <epoch> <seq>      followed by one 'HOSTNAME PORT' line per record and END
+#                        <seq> ADD HOSTNAME PORT     a change, numbered from 1 in each epoch
+#                        <seq> DEL HOSTNAME
+#                        HEARTBEAT <seq>             the latest change of the primary
+# A primary picks a new random epoch every time it starts, so secondaries of an earlier run get a snapshot.
+
+
+def valid_port(text: str) -> bool:
+    # the ports a primary can send, the same ones its configuration file and !ADD accept
+    return text.isdigit() and 1024 <= int(text) <= 65535
+
+
+def encode_mutation(seq: int, mutation: tuple) -> bytes:
+    # (7, ('ADD', 'www.google.com', 1234)) -> b'7 ADD www.google.com 1234\n'
+    return f"{seq} {' '.join(str(part) for part in mutation)}\n".encode(FORMAT)
+
+
+def apply_mutation(record: dict, mutation: tuple):
+    if mutation[0] == 'ADD':
+        record[mutation[1]] = int(mutation[2])
+    else:
+        record.pop(mutation[1], None)
+
+
+def set_interest(selector, sock, current: int, events: int, data) -> int:
+    # register, modify or unregister sock so the selector waits for events, and return them
+    if events == current:
+        return current
+    if not current:
+        selector.register(sock, events, data)
+    elif not events:
+        selector.unregister(sock)
+    else:
+        selector.modify(sock, events, data)
+    return events
+
+
+class ReplicaLink:
+    """
+    The primary's side of the connection to one secondary.
+    """
+
+    def __init__(self, primary, replica_socket):
+        self.primary = primary
+        self.socket = replica_socket
+        self.inbound = b''
+        self.outbound = bytearray()
+        self.snapshot = None
+        self.backlog = bytearray()
+        self.synced = False
+        self.events = 0
+        self.update_interest()
+
+    def queue(self, line: bytes):
+        # changes made while a snapshot is being sent are written after it
+        if not self.synced:
+            return
+        pending = self.backlog if self.snapshot is not None else self.outbound
+        pending += line
+        # a secondary that cannot keep up is dropped, it catches up again when it reconnects
+        if len(pending) > self.primary.max_buffer:
+            self.close()
+            return
+        self.update_interest()
+
+    def start_snapshot(self, epoch: str, seq: int, items: list):
+        self.outbound += f'SNAPSHOT {epoch} {seq}\n'.encode(FORMAT)
+        self.snapshot = iter(items)
+        self.fill()
+
+    def fill(self):
+        # queue the snapshot a chunk at a time instead of encoding the whole record at once
+        while self.snapshot is not None and len(self.outbound) < SNAPSHOT_CHUNK:
+            batch = list(islice(self.snapshot, SNAPSHOT_BATCH))
+            if not batch:
+                self.outbound += b'END\n' + self.backlog
+                self.backlog = bytearray()
+                self.snapshot = None
+                break
+            self.outbound += ''.join(f'{hostname} {port}\n' for hostname, port in batch).encode(FORMAT)
+
+    def handle_event(self, mask: int, now: float):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = self.socket.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                self.close()
+                return
+            if data and not self.synced:
+                self.inbound += data
+                if b'\n' in self.inbound:
+                    self.sync(self.inbound.split(b'\n', 1)[0])
+                elif len(self.inbound) > MAX_SYNC_LINE:
+                    self.close()
+                if self.socket is None:
+                    return
+
+        if mask & selectors.EVENT_WRITE and self.outbound:
+            try:
+                sent = self.socket.send(self.outbound)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close()
+                return
+            del self.outbound[:sent]
+            self.fill()
+        self.update_interest()
+
+    def sync(self, line: bytes):
+        parts = line.decode(FORMAT, 'replace').split()
+        if len(parts) != 3 or parts[0] != 'SYNC' or not parts[2].isdigit():
+            self.close()
+            return
+        self.synced = True
+        self.primary.catch_up(self, parts[1], int(parts[2]))
+
+    def update_interest(self):
+        if self.socket is None:
+            return
+        events = selectors.EVENT_READ
+        if self.outbound or self.snapshot is not None:
+            events |= selectors.EVENT_WRITE
+        self.events = set_interest(self.primary.selector, self.socket, self.events, events, self)
+
+    def close(self):
+        if self.socket is None:
+            return
+        self.events = set_interest(self.primary.selector, self.socket, self.events, 0, self)
+        self.socket.close()
+        self.socket = None
+        self.primary.links.discard(self)
+
+
+class Primary:
+    """
+    Accept secondaries on the replication port and stream every change of the record to them.
+    """
+
+    def __init__(self, selector, record: dict, port: int, log_size: int, max_buffer: int, heartbeat: float):
+        self.selector = selector
+        self.record = record
+        self.epoch = f'{random.getrandbits(64):016x}'
+        self.seq = 0
+        self.log = deque(maxlen=max(1, log_size))
+        self.max_buffer = max_buffer
+        self.heartbeat = heartbeat
+        self.next_heartbeat = 0.0
+        self.links = set()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('localhost', port))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        selector.register(self.listener, selectors.EVENT_READ, self)
+
+    def handle_event(self, mask: int, now: float):
+        # accept every waiting secondary
+        while True:
+            try:
+                replica_socket, _ = self.listener.accept()
+            except OSError:
+                return
+            replica_socket.setblocking(False)
+            self.links.add(ReplicaLink(self, replica_socket))
+
+    def publish(self, mutation: tuple):
+        self.seq += 1
+        line = encode_mutation(self.seq, mutation)
+        self.log.append((self.seq, line))
+        for link in list(self.links):
+            link.queue(line)
+
+    def catch_up(self, link: ReplicaLink, epoch: str, seq: int):
+        # replay the log if it still holds every change the secondary missed, else send a snapshot
+        missed = self.seq - seq
+        replay = None
+        if epoch == self.epoch and 0 <= missed <= len(self.log):
+            replay = b''.join(line for _, line in islice(self.log, len(self.log) - missed, None))
+        # a replay too big for the queue of the secondary would only get it dropped again
+        if replay is not None and len(replay) <= self.max_buffer:
+            link.queue(replay)
+        else:
+            link.start_snapshot(self.epoch, self.seq, list(self.record.items()))
+        link.update_interest()
+
+    def next_deadline(self):
+        return self.next_heartbeat if self.links else None
+
+    def on_timer(self, now: float):
+        # let idle secondaries know they are up to date
+        if now < self.next_heartbeat:
+            return
+        line = f'HEARTBEAT {self.seq}\n'.encode(FORMAT)
+        for link in list(self.links):
+            link.queue(line)
+        self.next_heartbeat = now + self.heartbeat
+
+    def lag(self, now: float) -> str:
+        return f'{self.seq} 0 0.0'
+
+
+class Secondary:
+    """
+    Follow a primary: apply its snapshot and changes to the record in order, reconnecting when the link breaks
+    or the primary stays silent for MISSED_HEARTBEATS heartbeat intervals.
+    """
+
+    def __init__(self, selector, record: dict, primary_port: int, retry: float, heartbeat: float):
+        self.selector = selector
+        self.record = record
+        self.primary_port = primary_port
+        self.retry = retry
+        # 0 never gives up on a silent primary
+        self.silence_timeout = heartbeat * MISSED_HEARTBEATS
+        self.epoch = '-'
+        self.applied = 0
+        self.head = 0
+        self.last_contact = None
+        # when the current link was made or last carried data
+        self.last_heard = None
+        self.socket = None
+        self.connecting = False
+        self.inbound = b''
+        self.outbound = bytearray()
+        # records of a snapshot being received, and the epoch and change it was taken at
+        self.staging = None
+        self.staging_epoch = None
+        self.staging_seq = 0
+        self.events = 0
+        self.next_attempt = 0.0
+        # called with the hostname a change applied to, or None after a snapshot replaced the record
+        self.on_change = None
+
+    def connect(self, now: float):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.connecting = True
+        self.last_heard = now
+        self.inbound = b''
+        self.outbound = bytearray(f'SYNC {self.epoch} {self.applied}\n'.encode(FORMAT))
+        self.staging = None
+        if self.socket.connect_ex(('localhost', self.primary_port)) not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.disconnect(now)
+            return
+        self.update_interest()
+
+    def disconnect(self, now: float, retry_now=False):
+        if self.socket is not None:
+            self.events = set_interest(self.selector, self.socket, self.events, 0, self)
+            self.socket.close()
+            self.socket = None
+        self.staging = None
+        self.next_attempt = now if retry_now else now + self.retry
+
+    def handle_event(self, mask: int, now: float):
+        if self.connecting:
+            if self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.disconnect(now)
+                return
+            self.connecting = False
+
+        if mask & selectors.EVENT_WRITE and self.outbound:
+            try:
+                sent = self.socket.send(self.outbound)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.disconnect(now)
+                return
+            del self.outbound[:sent]
+
+        if mask & selectors.EVENT_READ:
+            try:
+                data = self.socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                self.disconnect(now)
+                return
+            if data:
+                self.last_contact = self.last_heard = now
+                self.inbound += data
+                lines = self.inbound.split(b'\n')
+                self.inbound = lines.pop()
+                for line in lines:
+                    if not self.apply_line(line.decode(FORMAT, 'replace').split()):
+                        # out of order or garbled: start again from what was applied
+                        self.disconnect(now, retry_now=True)
+                        return
+        self.update_interest()
+
+    def apply_line(self, parts: list[str]) -> bool:
+        # apply one message of the primary, return False if the stream cannot be trusted any more
+        if self.staging is not None:
+            if parts == ['END']:
+                # only a complete snapshot moves the secondary to its epoch and change
+                self.record.clear()
+                self.record.update(self.staging)
+                self.epoch, self.applied = self.staging_epoch, self.staging_seq
+                self.staging = None
+                if self.on_change is not None:
+                    self.on_change(None)
+                return True
+            if len(parts) != 2 or not valid_port(parts[1]):
+                return False
+            self.staging[parts[0]] = int(parts[1])
+            return True
+
+        if len(parts) == 3 and parts[0] == 'SNAPSHOT' and parts[2].isdigit():
+            self.staging_epoch, self.staging_seq = parts[1], int(parts[2])
+            self.head = self.staging_seq
+            self.staging = {}
+            return True
+        if len(parts) == 2 and parts[0] == 'HEARTBEAT' and parts[1].isdigit():
+            self.head = int(parts[1])
+            return True
+        if len(parts) >= 3 and parts[0].isdigit() and parts[1] in ('ADD', 'DEL'):
+            seq = int(parts[0])
+            if seq <= self.applied:
+                return True
+            # a change that cannot be applied still shows the secondary is behind in !LAG
+            self.head = max(self.head, seq)
+            if seq != self.applied + 1:
+                return False
+            if parts[1] == 'ADD' and (len(parts) != 4 or not valid_port(parts[3])):
+                return False
+            if parts[1] == 'DEL' and len(parts) != 3:
+                return False
+            apply_mutation(self.record, tuple(parts[1:]))
+            if self.on_change is not None:
+                self.on_change(parts[2])
+            self.applied = seq
+            return True
+        return False
+
+    def update_interest(self):
+        if self.socket is None:
+            return
+        events = selectors.EVENT_WRITE if self.connecting else selectors.EVENT_READ
+        if self.outbound:
+            events |= selectors.EVENT_WRITE
+        self.events = set_interest(self.selector, self.socket, self.events, events, self)
+
+    def next_deadline(self):
+        if self.socket is None:
+            return self.next_attempt
+        return self.last_heard + self.silence_timeout if self.silence_timeout else None
+
+    def on_timer(self, now: float):
+        if self.socket is None:
+            if now >= self.next_attempt:
+                self.connect(now)
+        elif self.silence_timeout and now - self.last_heard > self.silence_timeout:
+            # a primary that stopped sending heartbeats may be gone without the link noticing
+            self.disconnect(now, retry_now=True)
+
+    def lag(self, now: float) -> str:
+        # last applied change, changes behind the primary, seconds since the primary was last heard from
+        silence = now - self.last_contact if self.last_contact is not None else -1.0
+        return f'{self.applied} {max(0, self.head - self.applied)} {silence:.1f}'
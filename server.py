@@ -1,8 +1,20 @@
+import errno
 import pathlib
+import selectors
 import socket
 import sys
+import time
+from collections import OrderedDict
 from sys import argv
 
+from hotnames import CACHE_POLICIES, HotNames
+from replication import Primary, Secondary
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 FORMAT = 'utf-8'
 
 
@@ -122,15 +134,17 @@ def add_cmd(client_socket, message: str, record: dict):
         # do nothing
         pass
 
-    # check valid port as well
-    if not (1024 <= int(each_part[2]) <= 65535) or not each_part[2].isdigit():
-        # do nothing
-        pass
+    # check valid port as well, before anything is changed or replicated
+    if not each_part[2].isdigit() or not (1024 <= int(each_part[2]) <= 65535):
+        client_socket.close()
+        return
     # After finishing checking, we assign each value to each placeholder
     domain, port_of_domain = each_part[1], each_part[2]
     # Overwrite if there exist a value
     record[domain] = int(port_of_domain)
     client_socket.close()
+    # hand the change back so it can be replicated
+    return 'ADD', domain, int(port_of_domain)
 
 
 # TODO: DEL Command -->> This is format: !DEL HOSTNAME\n
@@ -152,6 +166,7 @@ def del_cmd(client_socket, message: str, record: dict):
     # after finishing checking, we delete the domain
     record.pop(domain, None)
     client_socket.close()
+    return 'DEL', domain
 
 
 # TODO: EXIT Command
@@ -168,44 +183,484 @@ def process_message(client_socket, message: str, record: dict):
 
     # another attribute to server
     elif message.startswith('!ADD'):
-        add_cmd(client_socket, message, record)
+        return add_cmd(client_socket, message, record)
 
     # final attribute to server
     elif message.startswith('!DEL'):
-        del_cmd(client_socket, message, record)
+        return del_cmd(client_socket, message, record)
     else:
-        port = record.get(message, None)
-        # If the hostname exists, log and send the corresponding port
-        if port:
-            response = str(port) + '\n'
-            print(f'resolve {message} to {str(port)}')
-        # If the hostname doesn't exist, log NXDOMAIN and send NXDOMAIN\n
-        else:
-            response = "NXDOMAIN" + '\n'
-            print(f'resolve {message} to NXDOMAIN')
+        response = resolve_query(message, record)
         try:
             client_socket.sendall(response.encode(FORMAT))
         except Exception:
             return
 
 
-# TODO: Handle incomplete message
-def handle_incomplete_msg(buffer, client_socket, data_from_sender, record):
-    # flag = True # set the flag to extract each part of buffer
-    buffer += data_from_sender
-    # check if '\n' in incomplete_msg
-    while "\n" in buffer:
-        line, buffer = buffer.split('\n', 1)
-        process_message(client_socket, line, record)
-
+def resolve_query(message: str, record: dict) -> str:
+    port = record.get(message, None)
+    # If the hostname exists, log and send the corresponding port
+    if port:
+        response = str(port) + '\n'
+        print(f'resolve {message} to {str(port)}')
+    # If the hostname doesn't exist, log NXDOMAIN and send NXDOMAIN\n
+    else:
+        response = "NXDOMAIN" + '\n'
+        print(f'resolve {message} to NXDOMAIN')
+    return response
+
+
+# default limits of a server, each can be changed with --<name> <value> on the command line
+DEFAULT_OPTIONS = {
+    'max-connections': 1024,  # clients connected at the same time, more are turned away, at most the fd limit
+    'max-buffer': 4096,  # bytes of an unterminated line a client may send
+    'max-outbound': 65536,  # bytes of unsent responses before the server stops reading from a client
+    'idle-timeout': 30.0,  # seconds a client may stay silent, 0 disables it
+    'read-timeout': 5.0,  # seconds a line may stay unterminated, 0 disables it
+    'rate': 1000.0,  # queries per second of one client address, 0 disables the limit
+    'burst': 100,  # queries a client address may send at once
+    'write-rate': 10.0,  # !ADD and !DEL per second of one client address, 0 disables the limit
+    'write-burst': 10,  # !ADD and !DEL a client address may send at once
+    'max-clients': 65536,  # client addresses whose rate limits are remembered, least recently seen go first
+    'replication-port': 0,  # port secondaries replicate from when this server is a primary, 0 disables it
+    'primary': 0,  # replication port of the primary when this server is a read-only secondary
+    'log-size': 100000,  # changes a primary keeps for secondaries catching up without a snapshot
+    'replica-buffer': 4194304,  # bytes of changes queued for a secondary before it is dropped
+    'heartbeat': 1.0,  # seconds between primary heartbeats and secondary reconnects, 3 missed ones drop the link
+    'cache-size': 1024,  # responses of hot names kept ready, 0 disables the cache
+    'cache-policy': 'lfu',  # lru, or lfu to replace the least looked up cached name by one looked up more often
+    'cache-min-hits': 2,  # lookups a name needs before its response is cached
+    'top-k': 100,  # hottest names tracked for !TOP
+    'sketch-width': 4096,  # counters per row of the access frequency sketch
+    'sketch-depth': 4,  # rows of the access frequency sketch
+}
+
+# how many pending connections are accepted for each readiness event on the listening socket
+ACCEPT_BATCH = 64
+# file descriptors kept free for the listener, the selector, replication sockets and stdio
+RESERVED_FDS = 16
+# seconds before accepting again after running out of file descriptors with no client to drop
+ACCEPT_RETRY = 0.1
+# accept errors that mean the process or the system is out of resources rather than one client failed
+OUT_OF_RESOURCES = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+
+def connection_limit(requested: int) -> int:
+    # keep max-connections below the file descriptors the process may open
+    if resource is None:
+        return requested
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return requested
+    return max(1, min(requested, soft_limit - RESERVED_FDS))
+
+
+class TokenBucket:
+    """
+    Allow rate events per second on average and up to burst of them at once.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        # spend one token if there is one
+        if not self.rate:
+            return True
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def ready_at(self, now: float) -> float:
+        # when the next token becomes available
+        return now + max(0.0, 1 - self.tokens) / self.rate
+
+
+class ClientLimits:
+    """
+    Rate limits of one client address, shared by every connection it opens.
+    """
+    __slots__ = ('queries', 'writes', 'last_used')
+
+    def __init__(self, options: dict, now: float):
+        self.queries = TokenBucket(options['rate'], options['burst'], now)
+        self.writes = TokenBucket(options['write-rate'], options['write-burst'], now)
+        self.last_used = now
+
+    def refilled(self, now: float) -> bool:
+        # both buckets are full again, so forgetting them changes nothing
+        return all(not bucket.rate or now - self.last_used >= bucket.capacity / bucket.rate
+                   for bucket in (self.queries, self.writes))
+
+
+class ClientConnection:
+    """
+    State of one client: unprocessed input, unsent responses and the rate limits of its address.
+    It offers sendall and close so the commands can treat it like the client socket.
+    """
+    __slots__ = ('socket', 'inbound', 'outbound', 'closing', 'eof', 'last_activity', 'partial_since',
+                 'throttled_until', 'events', 'limits')
+
+    def __init__(self, client_socket, limits: ClientLimits, now: float):
+        self.socket = client_socket
+        self.inbound = b''
+        self.outbound = bytearray()
+        self.closing = False
+        self.eof = False
+        self.last_activity = now
+        self.partial_since = None
+        self.throttled_until = None
+        self.events = 0
+        self.limits = limits
+
+    def sendall(self, data: bytes):
+        # responses are queued and written once the socket can take them
+        self.outbound += data
+
+    def close(self):
+        # close once every queued response has been written
+        self.closing = True
+
+
+def parse_args(args: list[str]):
+    # server.py <configuration file> [--<option> <value> ...]
+    if not args or len(args) % 2 != 1:
+        print('INVALID ARGUMENTS')
+        sys.exit()
 
-def main(args: list[str]) -> None:
-    # TODO
-    if not args or len(args) != 1:
+    options = dict(DEFAULT_OPTIONS)
+    for flag, value in zip(args[1::2], args[2::2]):
+        name = flag[2:] if flag.startswith('--') else None
+        if name not in options:
+            print('INVALID ARGUMENTS')
+            sys.exit()
+        try:
+            options[name] = type(DEFAULT_OPTIONS[name])(value)
+        except ValueError:
+            print('INVALID ARGUMENTS')
+            sys.exit()
+        if isinstance(options[name], (int, float)) and options[name] < 0:
+            print('INVALID ARGUMENTS')
+            sys.exit()
+
+    # a server either serves changes to secondaries or follows a primary, not both
+    for name in ('replication-port', 'primary'):
+        if options[name] and not (1024 <= options[name] <= 65535):
+            print('INVALID ARGUMENTS')
+            sys.exit()
+    if options['replication-port'] and options['primary']:
+        print('INVALID ARGUMENTS')
+        sys.exit()
+    if options['cache-policy'] not in CACHE_POLICIES:
         print('INVALID ARGUMENTS')
         sys.exit()
 
-    configuration_file = args[0]
+    return args[0], options
+
+
+class Server:
+    """
+    Serve every client from one thread with a selector, within the limits of the options.
+    """
+
+    def __init__(self, server_socket, record: dict, options: dict):
+        self.server_socket = server_socket
+        self.record = record
+        self.options = options
+        self.connections = set()
+        self.throttled = set()
+        # client address -> ClientLimits, least recently seen first
+        self.limits = OrderedDict()
+        self.max_connections = connection_limit(options['max-connections'])
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(server_socket, selectors.EVENT_READ)
+        # when accepting stopped for lack of file descriptors, and when to try again
+        self.accept_paused_until = None
+        self.next_sweep = 0.0
+
+        # replication keeps the record of read-only secondaries in step with a primary
+        self.replication = None
+        if options['replication-port']:
+            self.replication = Primary(self.selector, record, options['replication-port'], options['log-size'],
+                                       options['replica-buffer'], options['heartbeat'])
+        elif options['primary']:
+            self.replication = Secondary(self.selector, record, options['primary'], options['heartbeat'],
+                                         options['heartbeat'])
+
+        # hot names get their responses from a small cache in front of the record
+        self.hot_names = None
+        if options['cache-size'] or options['top-k']:
+            self.hot_names = HotNames(options['cache-size'], options['cache-policy'], options['cache-min-hits'],
+                                      options['top-k'], options['sketch-width'], options['sketch-depth'])
+            if isinstance(self.replication, Secondary):
+                self.replication.on_change = self.hot_names.invalidate
+
+    def serve_forever(self):
+        while True:
+            self.serve_once()
+
+    def serve_once(self, max_wait=None):
+        # wait for the next event or deadline, at most max_wait seconds, and handle everything that is ready
+        timeout = self.select_timeout(time.monotonic())
+        if max_wait is not None:
+            timeout = max_wait if timeout is None else min(timeout, max_wait)
+        events = self.selector.select(timeout)
+        now = time.monotonic()
+        for key, mask in events:
+            if key.data is None:
+                self.accept_clients(now)
+                continue
+            if not isinstance(key.data, ClientConnection):
+                key.data.handle_event(mask, now)
+                continue
+            conn = key.data
+            if mask & selectors.EVENT_WRITE:
+                self.write_to(conn, now)
+            if mask & selectors.EVENT_READ and conn in self.connections:
+                self.read_from(conn, now)
+            if conn in self.connections:
+                self.process_lines(conn, now)
+
+        # clients whose rate limit has refilled carry on with their buffered lines
+        for conn in [conn for conn in self.throttled if conn.throttled_until <= now]:
+            self.throttled.discard(conn)
+            conn.throttled_until = None
+            self.process_lines(conn, now)
+
+        if self.accept_paused_until is not None and now >= self.accept_paused_until:
+            self.resume_accepting()
+        if now >= self.next_sweep:
+            self.drop_timed_out(now)
+        if self.replication is not None:
+            self.replication.on_timer(now)
+
+    def select_timeout(self, now: float):
+        # wake up for the next throttled client or the next timeout sweep
+        deadlines = [conn.throttled_until for conn in self.throttled]
+        if self.accept_paused_until is not None:
+            deadlines.append(self.accept_paused_until)
+        if self.replication is not None and self.replication.next_deadline() is not None:
+            deadlines.append(self.replication.next_deadline())
+        timeouts = [timeout for timeout in (self.options['idle-timeout'], self.options['read-timeout']) if timeout]
+        if timeouts and self.connections:
+            deadlines.append(self.next_sweep)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - now)
+
+    def accept_clients(self, now: float):
+        for _ in range(ACCEPT_BATCH):
+            try:
+                client_socket, address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                if error.errno not in OUT_OF_RESOURCES:
+                    # the client gave up before it was accepted
+                    continue
+                # the listener stays readable, so watching it now would only spin until a descriptor is freed
+                self.pause_accepting(now)
+                return
+            # turn clients away straight away rather than letting everybody slow down
+            if len(self.connections) >= self.max_connections:
+                client_socket.close()
+                continue
+            client_socket.setblocking(False)
+            conn = ClientConnection(client_socket, self.limits_for(address[0], now), now)
+            self.connections.add(conn)
+            # the query usually arrives with the connection, so read it before going back to the selector
+            self.read_from(conn, now)
+            if conn in self.connections:
+                self.process_lines(conn, now)
+
+    def pause_accepting(self, now: float):
+        if self.accept_paused_until is None:
+            self.selector.unregister(self.server_socket)
+        self.accept_paused_until = now + ACCEPT_RETRY
+
+    def resume_accepting(self):
+        if self.accept_paused_until is None:
+            return
+        self.accept_paused_until = None
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+    def limits_for(self, host: str, now: float) -> ClientLimits:
+        # reconnecting does not reset the rate limits of a client
+        limits = self.limits.pop(host, None)
+        if limits is None:
+            limits = ClientLimits(self.options, now)
+        self.limits[host] = limits
+        while len(self.limits) > self.options['max-clients']:
+            self.limits.popitem(last=False)
+        return limits
+
+    def read_from(self, conn: ClientConnection, now: float):
+        try:
+            data = conn.socket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.drop(conn)
+            return
+        if not data:
+            # the client has closed its side, answer what it already sent and close
+            conn.eof = True
+        conn.inbound += data
+        conn.last_activity = now
+
+    def write_to(self, conn: ClientConnection, now: float):
+        try:
+            sent = conn.socket.send(conn.outbound)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.drop(conn)
+            return
+        del conn.outbound[:sent]
+        conn.last_activity = now
+
+    def process_lines(self, conn: ClientConnection, now: float):
+        # answer complete lines while the client has tokens and its responses are being read
+        while True:
+            while b'\n' in conn.inbound and conn.throttled_until is None:
+                if len(conn.outbound) >= self.options['max-outbound']:
+                    break
+                line, rest = conn.inbound.split(b'\n', 1)
+                if line.startswith(b'!EXIT'):
+                    bucket = None
+                elif line.startswith(b'!ADD') or line.startswith(b'!DEL'):
+                    bucket = conn.limits.writes
+                else:
+                    bucket = conn.limits.queries
+                if bucket is not None:
+                    conn.limits.last_used = now
+                    if not bucket.take(now):
+                        conn.throttled_until = bucket.ready_at(now)
+                        self.throttled.add(conn)
+                        break
+                conn.inbound = rest
+                try:
+                    self.process_line(conn, line.decode(FORMAT), now)
+                except (UnicodeDecodeError, ValueError):
+                    self.drop(conn)
+                    return
+                if conn.closing:
+                    conn.inbound = b''
+
+            # most responses fit in the socket buffer, so write them now instead of waiting for the selector
+            if conn.outbound:
+                self.write_to(conn, now)
+                if conn not in self.connections:
+                    return
+            # carry on if the write made room for the responses of the lines still waiting
+            if (b'\n' not in conn.inbound or conn.throttled_until is not None or
+                    len(conn.outbound) >= self.options['max-outbound']):
+                break
+
+        # an unterminated line must stay short and must not take forever to arrive
+        tail = conn.inbound.rsplit(b'\n', 1)[-1]
+        if len(tail) > self.options['max-buffer']:
+            self.drop(conn)
+            return
+        conn.partial_since = (conn.partial_since or now) if tail else None
+        self.update_interest(conn)
+
+    def process_line(self, conn: ClientConnection, message: str, now: float):
+        # !LAG reports '<last change> <changes behind the primary> <seconds since the primary was heard from>'
+        if message.startswith('!LAG'):
+            lag = self.replication.lag(now) if self.replication is not None else '0 0 0.0'
+            conn.sendall(f'{lag}\n'.encode(FORMAT))
+            return
+        # secondaries only change through replication, so they are read-only to clients
+        if isinstance(self.replication, Secondary) and message.startswith(('!ADD', '!DEL')):
+            conn.close()
+            return
+        # !TOP <k> answers one 'HOSTNAME LOOKUPS' line for each of the k hottest names, then END
+        if message.startswith('!TOP'):
+            parts = message.split()
+            k = int(parts[1]) if len(parts) == 2 and parts[1].isdigit() else self.options['top-k']
+            hottest = self.hot_names.hottest(k) if self.hot_names is not None else []
+            conn.sendall(''.join(f'{name} {count}\n' for name, count in hottest).encode(FORMAT) + b'END\n')
+            return
+        if self.hot_names is not None and not message.startswith('!'):
+            self.answer_query(conn, message)
+            return
+        mutation = process_message(conn, message, self.record)
+        if mutation is not None:
+            if self.hot_names is not None:
+                self.hot_names.invalidate(mutation[1])
+            if isinstance(self.replication, Primary):
+                self.replication.publish(mutation)
+
+    def answer_query(self, conn: ClientConnection, message: str):
+        cached = self.hot_names.lookup(message)
+        if cached is not None:
+            response, encoded = cached
+            print(f'resolve {message} to {response.strip()}')
+        else:
+            response = resolve_query(message, self.record)
+            encoded = response.encode(FORMAT)
+            self.hot_names.offer(message, response, encoded)
+        conn.sendall(encoded)
+
+    def update_interest(self, conn: ClientConnection):
+        done = conn.closing or (conn.eof and b'\n' not in conn.inbound)
+        if done and not conn.outbound:
+            self.drop(conn)
+            return
+        # stop reading while the client has lines waiting for tokens or leaves its responses unread
+        events = 0
+        if (not conn.closing and not conn.eof and conn.throttled_until is None and b'\n' not in conn.inbound and
+                len(conn.outbound) < self.options['max-outbound']):
+            events |= selectors.EVENT_READ
+        if conn.outbound:
+            events |= selectors.EVENT_WRITE
+        if events == conn.events:
+            return
+        if not conn.events:
+            self.selector.register(conn.socket, events, conn)
+        elif not events:
+            self.selector.unregister(conn.socket)
+        else:
+            self.selector.modify(conn.socket, events, conn)
+        conn.events = events
+
+    def drop_timed_out(self, now: float):
+        idle_timeout, read_timeout = self.options['idle-timeout'], self.options['read-timeout']
+        for conn in list(self.connections):
+            if idle_timeout and now - conn.last_activity > idle_timeout:
+                self.drop(conn)
+            elif read_timeout and conn.partial_since is not None and now - conn.partial_since > read_timeout:
+                self.drop(conn)
+        # forget the limits of addresses that have been quiet long enough for their buckets to refill
+        for host in [host for host, limits in self.limits.items() if limits.refilled(now)]:
+            del self.limits[host]
+        # sweep often enough that nobody overstays a timeout by more than a quarter of it
+        timeouts = [timeout for timeout in (idle_timeout, read_timeout) if timeout]
+        self.next_sweep = now + (min(timeouts) / 4 if timeouts else 1.0)
+
+    def drop(self, conn: ClientConnection):
+        if conn not in self.connections:
+            return
+        self.connections.discard(conn)
+        self.throttled.discard(conn)
+        if conn.events:
+            self.selector.unregister(conn.socket)
+            conn.events = 0
+        conn.socket.close()
+        # a descriptor is free again, so new clients can be accepted
+        self.resume_accepting()
+
+
+def main(args: list[str]) -> None:
+    configuration_file, options = parse_args(args)
+
     # check configuration file does not exist, cannot be read or is invalid
     if not pathlib.Path(configuration_file).is_file():  # use pathlib module
         print("INVALID CONFIGURATION")
@@ -213,28 +668,17 @@ def main(args: list[str]) -> None:
 
     # Load configuration file
 
-    record, port_of_server = load_config(args[0])
+    record, port_of_server = load_config(configuration_file)
 
     # create a server
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # using TCP connection
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # REUSEADDR FOR MULTIPLE USER ACCESS
     server_socket.bind(("localhost", port_of_server))
     server_socket.listen()  # accept multiple connection
+    server_socket.setblocking(False)
 
-    while True:
-        CONN, ADDR = server_socket.accept()
-        buffer = ""
-
-        while True:
-            try:
-                msg = CONN.recv(1024).decode(FORMAT)
-                if not msg:
-                    break  # Connection was closed by client
-                handle_incomplete_msg(buffer, CONN, msg, record)
-            except Exception:
-                break
-        CONN.close()
+    Server(server_socket, record, options).serve_forever()
 
 
 if __name__ == "__main__":
-    main(argv[1:])
\ No newline at end of file
+    main(argv[1:])
@@ -0,0 +1,118 @@
+from hotnames import CountMinSketch, HotNames
+
+
+def make_hot_names(cache_size=2, policy='lru', min_hits=1, top_k=10, width=1024, depth=4):
+    return HotNames(cache_size, policy, min_hits, top_k, width, depth)
+
+
+def look_up(hot_names, name, times=1):
+    # look name up and offer its response the way the server does on a miss
+    entry = None
+    for _ in range(times):
+        entry = hot_names.lookup(name)
+        if entry is None:
+            hot_names.offer(name, f'{name}\n', f'{name}\n'.encode())
+    return entry
+
+
+def test_sketch_never_undercounts():
+    sketch = CountMinSketch(8, 3)
+    for i in range(20):
+        for _ in range(i % 5):
+            sketch.add(f'n{i}')
+    assert all(sketch.estimate(f'n{i}') >= i % 5 for i in range(20))
+
+
+def test_sketch_ages_after_sample_additions():
+    sketch = CountMinSketch(64, 2, sample=10)
+    for _ in range(9):
+        sketch.add('a')
+    assert sketch.estimate('a') == 9
+    sketch.add('a')
+    assert sketch.estimate('a') == 5
+    assert sketch.additions == 0
+
+
+def test_aging_with_full_top_k():
+    hot_names = make_hot_names(cache_size=0, top_k=2, width=4, depth=2)
+    for i in range(39):
+        hot_names.lookup('a' if i % 2 else 'b')
+    # the 40th lookup ages the sketch while the top names are full and the name is not among them
+    hot_names.lookup('c')
+    hot_names.lookup('d')
+    assert len(hot_names.top) <= 2
+    assert hot_names.coldest in hot_names.top
+
+
+def test_aging_halves_top_names():
+    hot_names = HotNames(0, 'lru', 1, 10, 1024, 4)
+    hot_names.sketch.sample = 10
+    for _ in range(9):
+        hot_names.lookup('a')
+    assert hot_names.hottest(1) == [('a', 9)]
+    hot_names.lookup('a')
+    assert hot_names.hottest(1) == [('a', 5)]
+
+
+def test_hottest_orders_by_lookups():
+    hot_names = make_hot_names(cache_size=0, top_k=2)
+    look_up(hot_names, 'a', 3)
+    look_up(hot_names, 'b', 5)
+    look_up(hot_names, 'c', 4)
+    assert hot_names.hottest(5) == [('b', 5), ('c', 4)]
+    assert hot_names.hottest(1) == [('b', 5)]
+
+
+def test_colder_newcomer_becomes_coldest():
+    hot_names = make_hot_names(cache_size=0, top_k=2)
+    look_up(hot_names, 'a', 5)
+    look_up(hot_names, 'b', 1)
+    look_up(hot_names, 'c', 4)
+    assert hot_names.hottest(5) == [('a', 5), ('c', 4)]
+
+
+def test_cold_names_are_not_cached():
+    hot_names = make_hot_names(min_hits=2)
+    assert look_up(hot_names, 'a') is None
+    assert 'a' not in hot_names.cache
+    look_up(hot_names, 'a')
+    assert look_up(hot_names, 'a') == ('a\n', b'a\n')
+
+
+def test_lru_evicts_least_recently_used():
+    hot_names = make_hot_names(cache_size=2, policy='lru')
+    look_up(hot_names, 'a')
+    look_up(hot_names, 'b')
+    assert look_up(hot_names, 'a') is not None
+    look_up(hot_names, 'c')
+    assert list(hot_names.cache) == ['a', 'c']
+
+
+def test_lfu_keeps_names_looked_up_more_often():
+    hot_names = make_hot_names(cache_size=1, policy='lfu')
+    look_up(hot_names, 'a', 5)
+    look_up(hot_names, 'b', 2)
+    assert list(hot_names.cache) == ['a']
+    look_up(hot_names, 'b', 5)
+    assert list(hot_names.cache) == ['b']
+
+
+def test_lfu_evicts_least_looked_up_not_least_recent():
+    hot_names = make_hot_names(cache_size=2, policy='lfu')
+    look_up(hot_names, 'b', 2)
+    look_up(hot_names, 'a', 5)
+    look_up(hot_names, 'b')
+    # a is the least recently used, but b is looked up less often
+    look_up(hot_names, 'c', 4)
+    assert sorted(hot_names.cache) == ['a', 'c']
+
+
+def test_invalidate_one_name_or_all():
+    hot_names = make_hot_names(cache_size=3)
+    for name in ('a', 'b', 'c'):
+        look_up(hot_names, name)
+    hot_names.invalidate('b')
+    assert list(hot_names.cache) == ['a', 'c']
+    assert hot_names.lookup('b') is None
+    hot_names.invalidate()
+    assert not hot_names.cache
@@ -0,0 +1,197 @@
+import selectors
+import socket
+import time
+
+from replication import Primary, Secondary, encode_mutation
+from server import DEFAULT_OPTIONS, Server
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def make_secondary(record=None):
+    return Secondary(selectors.DefaultSelector(), {} if record is None else record, free_port(), 1.0, 1.0)
+
+
+def feed(secondary, *lines):
+    return [secondary.apply_line(line.split()) for line in lines]
+
+
+def test_changes_apply_in_order():
+    record = {'old.a.com': 1}
+    secondary = make_secondary(record)
+    assert feed(secondary, '1 ADD www.a.com 2000', '2 DEL old.a.com', '3 ADD www.a.com 2001') == [True] * 3
+    assert record == {'www.a.com': 2001}
+    assert secondary.applied == 3
+
+
+def test_replayed_change_is_skipped():
+    record = {}
+    secondary = make_secondary(record)
+    feed(secondary, '1 ADD www.a.com 2000', '2 DEL www.a.com')
+    assert feed(secondary, '1 ADD www.a.com 2000') == [True]
+    assert record == {}
+    assert secondary.applied == 2
+
+
+def test_gap_is_rejected_without_applying():
+    record = {}
+    secondary = make_secondary(record)
+    assert feed(secondary, '1 ADD www.a.com 2000', '3 ADD ftp.a.com 2001') == [True, False]
+    assert record == {'www.a.com': 2000}
+    assert secondary.applied == 1
+
+
+def test_garbled_change_is_rejected():
+    secondary = make_secondary()
+    assert feed(secondary, '1 ADD www.a.com') == [False]
+    assert feed(secondary, '1 ADD www.a.com port') == [False]
+    assert feed(secondary, '1 ADD www.a.com 99') == [False]
+    assert feed(secondary, '1 DEL www.a.com extra') == [False]
+    assert feed(secondary, 'NONSENSE') == [False]
+    assert secondary.applied == 0
+
+
+def test_rejected_change_shows_in_lag():
+    secondary = make_secondary()
+    feed(secondary, '1 ADD www.a.com 2000', '2 ADD ftp.a.com 70000')
+    assert secondary.lag(time.monotonic()).split()[:2] == ['1', '1']
+    feed(secondary, '5 DEL www.a.com')
+    assert secondary.lag(time.monotonic()).split()[:2] == ['1', '4']
+
+
+def test_snapshot_replaces_record_at_end():
+    record = {'old.a.com': 1}
+    changed = []
+    secondary = make_secondary(record)
+    secondary.on_change = changed.append
+    assert feed(secondary, 'SNAPSHOT abcd 50', 'www.a.com 2000', 'ftp.a.com 2001') == [True] * 3
+    # nothing is visible before END
+    assert record == {'old.a.com': 1}
+    assert (secondary.epoch, secondary.applied) == ('-', 0)
+
+    assert feed(secondary, 'END', '51 DEL ftp.a.com') == [True, True]
+    assert record == {'www.a.com': 2000}
+    assert (secondary.epoch, secondary.applied) == ('abcd', 51)
+    assert changed == [None, 'ftp.a.com']
+
+
+def test_disconnect_mid_snapshot_keeps_old_state():
+    record = {'old.a.com': 1}
+    secondary = make_secondary(record)
+    feed(secondary, '1 ADD www.a.com 2000')
+    feed(secondary, 'SNAPSHOT abcd 50', 'new.a.com 3000')
+    secondary.disconnect(time.monotonic())
+
+    assert record == {'old.a.com': 1, 'www.a.com': 2000}
+    assert (secondary.epoch, secondary.applied) == ('-', 1)
+    # the next SYNC asks for what was really applied, so the primary sends a new snapshot
+    secondary.connect(time.monotonic())
+    assert bytes(secondary.outbound) == b'SYNC - 1\n'
+    secondary.disconnect(time.monotonic())
+
+
+def test_heartbeat_reports_lag():
+    secondary = make_secondary()
+    feed(secondary, '1 ADD www.a.com 2000', 'HEARTBEAT 4')
+    assert secondary.lag(time.monotonic()).split()[:2] == ['1', '3']
+
+
+def test_encode_mutation():
+    assert encode_mutation(7, ('ADD', 'www.a.com', 1234)) == b'7 ADD www.a.com 1234\n'
+    assert encode_mutation(8, ('DEL', 'www.a.com')) == b'8 DEL www.a.com\n'
+
+
+def spin(selector, *nodes, seconds=0.3):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for key, mask in selector.select(0.01):
+            key.data.handle_event(mask, time.monotonic())
+        for node in nodes:
+            node.on_timer(time.monotonic())
+
+
+def test_secondary_follows_primary_and_catches_up_from_log():
+    selector = selectors.DefaultSelector()
+    primary_record = {'www.a.com': 2000}
+    secondary_record = {}
+    primary = Primary(selector, primary_record, free_port(), 100, 1 << 20, 0.05)
+    secondary = Secondary(selector, secondary_record, primary.listener.getsockname()[1], 0.02, 0.05)
+    try:
+        spin(selector, primary, secondary)
+        assert secondary_record == {'www.a.com': 2000}
+
+        secondary.disconnect(time.monotonic())
+        for i in range(3):
+            primary_record[f'h{i}.a.com'] = 3000 + i
+            primary.publish(('ADD', f'h{i}.a.com', 3000 + i))
+        spin(selector, primary, secondary)
+        assert secondary_record == primary_record
+        assert secondary.applied == primary.seq == 3
+    finally:
+        secondary.disconnect(time.monotonic())
+        primary.listener.close()
+
+
+def test_silent_primary_is_reconnected():
+    selector = selectors.DefaultSelector()
+    # a primary that accepts secondaries but never sends anything
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost', 0))
+    listener.listen()
+    secondary = Secondary(selector, {}, listener.getsockname()[1], 0.02, 0.05)
+    links = []
+    try:
+        spin(selector, secondary, seconds=0.05)
+        assert secondary.next_deadline() <= secondary.last_heard + 0.15
+        links.append(listener.accept()[0])
+        spin(selector, secondary, seconds=0.3)
+        listener.settimeout(0.5)
+        links.append(listener.accept()[0])
+        assert links[1].recv(64) == b'SYNC - 0\n'
+    finally:
+        secondary.disconnect(time.monotonic())
+        for link in links:
+            link.close()
+        listener.close()
+
+
+def make_server(record, **options):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost', 0))
+    listener.listen()
+    listener.setblocking(False)
+    return Server(listener, record, dict(DEFAULT_OPTIONS, **options))
+
+
+def spin_servers(*servers, seconds=0.3):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for srv in servers:
+            srv.serve_once(0.005)
+
+
+def test_bad_add_is_neither_applied_nor_published():
+    primary = make_server({'www.a.com': 2000}, **{'replication-port': free_port(), 'heartbeat': 0.05})
+    secondary = make_server({}, primary=primary.replication.listener.getsockname()[1], heartbeat=0.05)
+    try:
+        spin_servers(primary, secondary)
+        assert secondary.record == {'www.a.com': 2000}
+
+        for command in (b'!ADD www.b.com 99\n', b'!ADD www.b.com 70000\n', b'!ADD www.b.com -2000\n',
+                        b'!ADD www.c.com 3000\n'):
+            with socket.create_connection(primary.server_socket.getsockname()) as client:
+                client.sendall(command)
+                spin_servers(primary, secondary, seconds=0.05)
+        spin_servers(primary, secondary)
+        assert primary.record == secondary.record == {'www.a.com': 2000, 'www.c.com': 3000}
+        assert primary.replication.seq == secondary.replication.applied == 1
+        assert secondary.replication.lag(time.monotonic()).split()[:2] == ['1', '0']
+    finally:
+        secondary.replication.disconnect(time.monotonic())
+        primary.replication.listener.close()
+        for srv in (primary, secondary):
+            srv.server_socket.close()
@@ -0,0 +1,217 @@
+import errno
+import selectors
+import socket
+import time
+
+import pytest
+
+import server
+from server import DEFAULT_OPTIONS, ClientConnection, ClientLimits, Server, TokenBucket
+
+
+def listen(listener_class=socket.socket):
+    listener = listener_class(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost', 0))
+    listener.listen()
+    listener.setblocking(False)
+    return listener
+
+
+def make_server(listener=None, **options):
+    # options are given with underscores, e.g. max_buffer=16 for --max-buffer 16
+    options = dict(DEFAULT_OPTIONS, **{name.replace('_', '-'): value for name, value in options.items()})
+    return Server(listener or listen(), {'www.a.com': 2000}, options)
+
+
+def connect(srv):
+    client = socket.create_connection(srv.server_socket.getsockname())
+    client.settimeout(0.5)
+    return client
+
+
+def spin(srv, seconds=0.1):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        srv.serve_once(0.01)
+
+
+def close(srv):
+    for conn in list(srv.connections):
+        srv.drop(conn)
+    srv.selector.close()
+    srv.server_socket.close()
+
+
+def test_bucket_spends_burst_then_refills():
+    bucket = TokenBucket(2.0, 2, 0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [True, True, False]
+    assert bucket.ready_at(0.0) == 0.5
+    assert not bucket.take(0.4)
+    assert bucket.take(0.5)
+    # it never holds more than its burst
+    assert [bucket.take(100.0) for _ in range(3)] == [True, True, False]
+
+
+def test_bucket_without_rate_never_limits():
+    bucket = TokenBucket(0.0, 1, 0.0)
+    assert all(bucket.take(0.0) for _ in range(10))
+
+
+def test_limits_are_refilled_once_every_bucket_is_full():
+    options = dict(DEFAULT_OPTIONS, rate=10.0, burst=5)
+    options.update({'write-rate': 1.0, 'write-burst': 2})
+    limits = ClientLimits(options, 0.0)
+    assert not limits.refilled(1.0)
+    assert limits.refilled(2.0)
+
+    options['write-rate'] = 0.0
+    assert ClientLimits(options, 0.0).refilled(0.5)
+
+
+def test_least_recently_seen_address_is_evicted():
+    srv = make_server(max_clients=2)
+    try:
+        first = srv.limits_for('10.0.0.1', 0.0)
+        srv.limits_for('10.0.0.2', 0.0)
+        assert srv.limits_for('10.0.0.1', 1.0) is first
+        srv.limits_for('10.0.0.3', 2.0)
+        assert list(srv.limits) == ['10.0.0.1', '10.0.0.3']
+    finally:
+        close(srv)
+
+
+def test_idle_addresses_are_forgotten():
+    srv = make_server(rate=10.0, burst=5, write_rate=1.0, write_burst=2)
+    try:
+        srv.limits_for('10.0.0.1', 0.0)
+        srv.drop_timed_out(1.0)
+        assert '10.0.0.1' in srv.limits
+        srv.drop_timed_out(2.0)
+        assert srv.limits == {}
+    finally:
+        close(srv)
+
+
+def test_fresh_connections_share_the_limit_of_their_address():
+    srv = make_server(rate=1.0, burst=2)
+    clients = []
+    try:
+        for _ in range(3):
+            client = connect(srv)
+            client.sendall(b'www.a.com\n')
+            clients.append(client)
+            spin(srv, 0.05)
+        assert clients[0].recv(64) == b'2000\n'
+        assert clients[1].recv(64) == b'2000\n'
+        # the third connection waits for a token instead of starting with a full bucket
+        assert len(srv.throttled) == 1
+        clients[2].settimeout(0.05)
+        with pytest.raises(socket.timeout):
+            clients[2].recv(64)
+        spin(srv, 1.0)
+        clients[2].settimeout(0.5)
+        assert clients[2].recv(64) == b'2000\n'
+    finally:
+        for client in clients:
+            client.close()
+        close(srv)
+
+
+def test_long_unterminated_line_is_dropped():
+    srv = make_server(max_buffer=16)
+    client = connect(srv)
+    try:
+        client.sendall(b'x' * 100)
+        spin(srv)
+        assert client.recv(64) == b''
+        assert not srv.connections
+    finally:
+        client.close()
+        close(srv)
+
+
+def test_reading_stops_while_responses_are_unread():
+    srv = make_server(max_outbound=64, rate=0.0)
+    server_end, client_end = socket.socketpair()
+    server_end.setblocking(False)
+    try:
+        # fill the socket so no response can be written
+        while True:
+            try:
+                server_end.send(b'x' * 65536)
+            except BlockingIOError:
+                break
+        now = time.monotonic()
+        conn = ClientConnection(server_end, srv.limits_for('10.0.0.1', now), now)
+        srv.connections.add(conn)
+        conn.inbound = b'www.a.com\n' * 100
+        srv.process_lines(conn, now)
+        assert len(conn.outbound) >= 64
+        assert b'\n' in conn.inbound
+        assert conn.events == selectors.EVENT_WRITE
+
+        # once the client reads, the rest of its lines are answered
+        client_end.setblocking(False)
+        answers = b''
+        deadline = time.monotonic() + 2.0
+        while answers.count(b'2000\n') < 100 and time.monotonic() < deadline:
+            try:
+                answers += client_end.recv(1 << 20).replace(b'x', b'')
+            except BlockingIOError:
+                pass
+            srv.serve_once(0.01)
+        assert answers == b'2000\n' * 100
+    finally:
+        client_end.close()
+        close(srv)
+
+
+class FullListener(socket.socket):
+    # a listener whose process has run out of file descriptors
+    def accept(self):
+        raise OSError(errno.EMFILE, 'Too many open files')
+
+
+def test_out_of_descriptors_stops_watching_the_listener():
+    srv = make_server(listen(FullListener))
+    client = connect(srv)
+    try:
+        srv.serve_once(0.1)
+        assert srv.accept_paused_until is not None
+        with pytest.raises(KeyError):
+            srv.selector.get_key(srv.server_socket)
+
+        # dropping a client frees a descriptor, so the listener is watched again
+        server_end, other_end = socket.socketpair()
+        conn = ClientConnection(server_end, srv.limits_for('10.0.0.1', 0.0), 0.0)
+        srv.connections.add(conn)
+        srv.drop(conn)
+        other_end.close()
+        assert srv.accept_paused_until is None
+        assert srv.selector.get_key(srv.server_socket)
+    finally:
+        client.close()
+        close(srv)
+
+
+def test_accepting_is_retried_without_clients_to_drop():
+    srv = make_server(listen(FullListener))
+    client = connect(srv)
+    try:
+        srv.serve_once(0.1)
+        paused_until = srv.accept_paused_until
+        assert srv.select_timeout(time.monotonic()) <= server.ACCEPT_RETRY
+        # the listener is watched again after a while and, still failing, set aside again
+        deadline = time.monotonic() + 1.0
+        while (srv.accept_paused_until or 0.0) <= paused_until and time.monotonic() < deadline:
+            srv.serve_once(0.01)
+        assert srv.accept_paused_until > paused_until
+    finally:
+        client.close()
+        close(srv)
+
+
+def test_max_connections_fits_the_file_limit(monkeypatch):
+    monkeypatch.setattr(server.resource, 'getrlimit', lambda _: (100, 4096))
+    assert server.connection_limit(1024) == 100 - server.RESERVED_FDS
+    assert server.connection_limit(10) == 10
@@ -0,0 +1,206 @@
+import json
+import os
+from itertools import count
+
+import verifier
+from launcher import generate_single_config_file
+from verifier import validate_and_compare_single_file_path
+
+MASTER = {
+    'www.google.com': 2001,
+    'mail.google.com': 2002,
+    'www.yahoo.com': 2003,
+    'www.wiki.org': 2004,
+    'ftp.wiki.org': 2005,
+}
+
+
+def write_singles(tmp_path, record=MASTER):
+    # generate the single files with launcher.py, handing out ports 3000, 3001, ... in order
+    singles = tmp_path / 'singles'
+    singles.mkdir()
+    ports = count(3000)
+    generate_single_config_file(str(singles), record, 1500, port_allocator=lambda: next(ports))
+    return singles
+
+
+def replace_line(path, old, new):
+    path.write_text(path.read_text().replace(old, new))
+
+
+def test_generated_files_are_eq(tmp_path):
+    report = validate_and_compare_single_file_path(MASTER, write_singles(tmp_path))
+    assert report.lines() == ['eq']
+
+
+def test_wrong_port_is_neq(tmp_path):
+    singles = write_singles(tmp_path)
+    replace_line(singles / 'auth-google.conf', 'www.google.com, 2001', 'www.google.com, 2999')
+    report = validate_and_compare_single_file_path(MASTER, singles)
+    assert report.lines() == ['neq',
+                              'auth-google.conf: www.google.com resolves to 2999, master has 2001',
+                              'missing www.google.com']
+
+
+def test_duplicate_record_does_not_hide_missing_one(tmp_path):
+    singles = write_singles(tmp_path)
+    replace_line(singles / 'auth-google.conf', 'mail.google.com, 2002\n', 'www.google.com, 2001\n')
+    report = validate_and_compare_single_file_path(MASTER, singles)
+    assert report.verdict == 'neq'
+    assert 'missing mail.google.com' in report.lines()
+
+
+def test_record_not_in_master_is_neq(tmp_path):
+    singles = write_singles(tmp_path)
+    with open(singles / 'auth-wiki.conf', 'a') as f_obj:
+        f_obj.write('new.wiki.org, 2006\n')
+    report = validate_and_compare_single_file_path(MASTER, singles)
+    assert report.lines() == ['neq', 'auth-wiki.conf: new.wiki.org is not in master']
+
+
+def test_malformed_file_is_invalid(tmp_path):
+    singles = write_singles(tmp_path)
+    replace_line(singles / 'auth-yahoo.conf', 'www.yahoo.com, 2003', 'www.yahoo.com 2003')
+    report = validate_and_compare_single_file_path(MASTER, singles)
+    assert report.verdict == 'invalid single'
+    assert 'invalid single auth-yahoo.conf' in report.lines()
+
+
+def test_missing_root_file_is_invalid(tmp_path):
+    singles = write_singles(tmp_path)
+    (singles / 'root-conf').unlink()
+    report = validate_and_compare_single_file_path(MASTER, singles)
+    assert 'invalid single root-conf' in report.lines()
+
+
+def test_tld_named_file_must_match_root(tmp_path):
+    singles = write_singles(tmp_path)
+    tld_com = (singles / 'tld-com.conf').read_text()
+    (singles / 'com.conf').write_text(tld_com)
+    assert validate_and_compare_single_file_path(MASTER, singles).lines() == ['eq']
+
+    (singles / 'com-org.conf').write_text(tld_com)
+    report = validate_and_compare_single_file_path(MASTER, singles)
+    assert report.verdict == 'neq'
+    assert any(line.startswith('com-org.conf: listens on') and line.endswith('for org') for line in report.lines())
+
+
+def test_process_pool_gives_the_same_report(tmp_path, monkeypatch):
+    singles = write_singles(tmp_path)
+    replace_line(singles / 'auth-google.conf', 'www.google.com, 2001', 'www.google.com, 2999')
+    serial = validate_and_compare_single_file_path(MASTER, singles, jobs=1)
+
+    pools = []
+
+    class RecordingPool(verifier.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(kwargs)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(verifier, 'PARALLEL_THRESHOLD', 1)
+    monkeypatch.setattr(verifier, 'ProcessPoolExecutor', RecordingPool)
+    pooled = validate_and_compare_single_file_path(MASTER, singles, jobs=2)
+    assert len(pools) == 1
+    assert pooled.lines() == serial.lines()
+    assert pooled.verdict == 'neq'
+
+
+def write_master(tmp_path, record=MASTER):
+    master = tmp_path / 'master.conf'
+    master.write_text('1500\n' + ''.join(f'{hostname},{port}\n' for hostname, port in record.items()))
+    return master
+
+
+def checked_files(monkeypatch):
+    # record which auth files every run actually checks
+    runs = []
+    check_auth_files = verifier.check_auth_files
+
+    def recording(paths, *args):
+        runs.append(sorted(os.path.basename(path) for path in paths))
+        return check_auth_files(paths, *args)
+
+    monkeypatch.setattr(verifier, 'check_auth_files', recording)
+    return runs
+
+
+def verify(master, singles, full=False):
+    return validate_and_compare_single_file_path(MASTER, singles, master_file_path=master, full=full)
+
+
+ALL_AUTH = ['auth-google.conf', 'auth-wiki.conf', 'auth-yahoo.conf']
+
+
+def test_second_run_reuses_the_cache(tmp_path, monkeypatch):
+    master, singles = write_master(tmp_path), write_singles(tmp_path)
+    runs = checked_files(monkeypatch)
+    assert verify(master, singles).lines() == ['eq']
+    assert verify(master, singles).lines() == ['eq']
+    assert runs == [ALL_AUTH, []]
+    assert (singles / verifier.CACHE_FILE_NAME).exists()
+
+
+def test_only_changed_auth_files_are_checked_again(tmp_path, monkeypatch):
+    master, singles = write_master(tmp_path), write_singles(tmp_path)
+    runs = checked_files(monkeypatch)
+    verify(master, singles)
+    replace_line(singles / 'auth-wiki.conf', 'ftp.wiki.org, 2005', 'ftp.wiki.org, 20050')
+    assert verify(master, singles).verdict == 'neq'
+    # touching a file without changing it is recognised by its content hash
+    os.utime(singles / 'auth-yahoo.conf', ns=(0, 0))
+    assert verify(master, singles).verdict == 'neq'
+    assert runs == [ALL_AUTH, ['auth-wiki.conf'], []]
+
+
+def test_changed_master_root_or_tld_checks_everything(tmp_path, monkeypatch):
+    master, singles = write_master(tmp_path), write_singles(tmp_path)
+    runs = checked_files(monkeypatch)
+    verify(master, singles)
+    for path in (master, singles / 'root-conf', singles / 'tld-org.conf'):
+        with open(path, 'a') as f_obj:
+            f_obj.write('\n')
+        verify(master, singles)
+        path.write_text(path.read_text()[:-1])
+        verify(master, singles)
+    assert runs == [ALL_AUTH] * 7
+
+
+def test_full_ignores_the_cache(tmp_path, monkeypatch):
+    master, singles = write_master(tmp_path), write_singles(tmp_path)
+    runs = checked_files(monkeypatch)
+    verify(master, singles)
+    verify(master, singles, full=True)
+    assert runs == [ALL_AUTH, ALL_AUTH]
+
+
+def test_new_cache_format_checks_everything(tmp_path, monkeypatch):
+    master, singles = write_master(tmp_path), write_singles(tmp_path)
+    runs = checked_files(monkeypatch)
+    verify(master, singles)
+    monkeypatch.setattr(verifier, 'CACHE_FORMAT', verifier.CACHE_FORMAT + 1)
+    verify(master, singles)
+    assert runs == [ALL_AUTH, ALL_AUTH]
+
+
+def test_malformed_cache_entries_are_misses(tmp_path, monkeypatch):
+    master, singles = write_master(tmp_path), write_singles(tmp_path)
+    runs = checked_files(monkeypatch)
+    verify(master, singles)
+    cache_path = singles / verifier.CACHE_FILE_NAME
+    cache = json.loads(cache_path.read_text())
+    cache['files']['auth-google.conf'] = {'size': 1}
+    cache['files']['auth-wiki.conf']['matched'] = 3
+    cache_path.write_text(json.dumps(cache))
+    assert verify(master, singles).lines() == ['eq']
+
+    cache = json.loads(cache_path.read_text())
+    cache['files'] = [1]
+    cache_path.write_text(json.dumps(cache))
+    assert verify(master, singles).lines() == ['eq']
+    assert runs == [ALL_AUTH, ['auth-google.conf', 'auth-wiki.conf'], ALL_AUTH]
+
+
+def test_full_flag_is_parsed_anywhere():
+    assert verifier.validate_command_line_args(['master.conf', 'singles']) == ('master.conf', 'singles', False)
+    assert verifier.validate_command_line_args(['--full', 'master.conf', 'singles']) == ('master.conf', 'singles', True)
+    assert verifier.validate_command_line_args(['master.conf', 'singles', '--full']) == ('master.conf', 'singles', True)
@@ -1,11 +1,30 @@
+import hashlib
+import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from sys import argv
 
 from server import check_hostname
 
+# sidecar file in the single files directory holding the verdicts of the last run
+CACHE_FILE_NAME = '.verifier-cache.json'
+# part of the cache context, bump it whenever the checks or the layout of a cache entry change
+CACHE_FORMAT = 2
+
+# below this many auth files, starting a process pool costs more than it saves
+PARALLEL_THRESHOLD = 64
+
+# indexes shared with every worker process, filled in by init_worker
+_master_record = {}
+_delegations = {}
+
 
 def validate_command_line_args(args):
+    # --full ignores the cache and checks every file again
+    full = '--full' in args
+    args = [arg for arg in args if arg != '--full']
     # check number of arguments passed in
     if len(args) != 2:
         print('invalid arguments')
@@ -14,66 +33,59 @@ def validate_command_line_args(args):
     master_file_path = args[0]
     dir_path = args[1]
 
-    return master_file_path, dir_path
+    return master_file_path, dir_path, full
 
 
-def load_config_file(dir_path, fobj, file_type="master"):
-    try:  # extract file and read it
-        fobj = dir_path / fobj
-        with open(fobj, 'r') as filename:
-            lines = filename.readlines()
-    except IOError:
-        print(f'invalid {file_type}')
-        sys.exit()
-    # check if the file has only one line containing the port of the server
-    if len(lines) == 1:
-        print(f'invalid {file_type}')
-        sys.exit()
-    # extract port of server and check invalid port number
+def parse_port(text: str):
+    # return the port as an int, or None if it is not a valid port number
     try:
-        port_of_server = int(lines[0].strip())
-        if not (1024 <= port_of_server <= 65535):
-            print(f'invalid {file_type}')
-            sys.exit()
+        port = int(text.strip())
     except ValueError:
-        print(f'invalid {file_type}')
-        sys.exit()
+        return None
+    if not (1024 <= port <= 65535):
+        return None
+    return port
+
 
-    # create a dictionary to attach each port number of a domain
+def parse_single_file(path, min_labels=1):
+    """
+    Stream a configuration file once and return its records and the port of its server.
+    Raise ValueError if the file is malformed.
+    """
     record = {}
-    # loop through the list containing all information we extracted before except the first line
-    for each_line in lines[1:]:
-        # split the line and check if it's valid
-        parts = each_line.strip().split(',')
-        if len(parts) != 2:
-            print(f'invalid {file_type}')
-            sys.exit()
-        domain, port_identifier = parts
-        # check invalid domain and partial domain
-        if not check_hostname(domain) or len(domain.split('.')) < 3:
-            print(f'invalid {file_type}')
-            sys.exit()
-        try:  # check invalid port identifier
-            if not (1024 <= int(port_identifier) <= 65535):
-                print(f'invalid {file_type}')
-                sys.exit()
-        except ValueError:
-            print(f'invalid {file_type}')
-            sys.exit()
-
-        # check for contradicting records
-        if domain in record:  # access to dictionary
-            if record.get(domain) != int(port_identifier):  # check if the domain get 2 port then print Invalid
-                print(f'invalid {file_type}')
-                sys.exit()
-
-        # set the pair < key, value > in dictionary with each domain and port identifier
-        record[domain] = int(port_identifier)
-
-        # return the dictionary as the library contains address of all books and the port of the server
+    with open(path, 'r') as f_obj:
+        # the first line holds the port of the server
+        port_of_server = parse_port(f_obj.readline())
+        if port_of_server is None:
+            raise ValueError(path)
+        for each_line in f_obj:
+            # split the line and check if it's valid
+            parts = each_line.strip().split(',')
+            if len(parts) != 2:
+                raise ValueError(path)
+            domain, port_identifier = parts[0].strip(), parse_port(parts[1])
+            # check invalid domain, partial domain and invalid port identifier
+            if port_identifier is None or not check_hostname(domain) or len(domain.split('.')) < min_labels:
+                raise ValueError(path)
+            # check for contradicting records
+            if record.get(domain, port_identifier) != port_identifier:
+                raise ValueError(path)
+            record[domain] = port_identifier
+
+    # a file containing only the port of the server is invalid
+    if not record:
+        raise ValueError(path)
     return record, port_of_server
 
 
+def load_config_file(dir_path, fobj, file_type="master"):
+    try:  # extract file and read it
+        return parse_single_file(Path(dir_path) / fobj, min_labels=3)
+    except (IOError, ValueError):
+        print(f'invalid {file_type}')
+        sys.exit()
+
+
 # validate content and existence first before compare
 def validate_master_file(file: str):
     master_file_path = Path(file)
@@ -86,99 +98,289 @@ def validate_master_file(file: str):
     return load_config_file("", master_file_path)
 
 
-def validate_and_compare_single_file_path(master_record: dict, file: str):
+def file_digest(path) -> str:
+    # sha256 of the content of a file, read in blocks
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f_obj:
+        for block in iter(lambda: f_obj.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_cache(dir_path: Path, context: str) -> dict:
+    # return the cached verdicts, or nothing if they were made against another master, root or TLD files
+    try:
+        with open(dir_path / CACHE_FILE_NAME, 'r') as f_obj:
+            cache = json.load(f_obj)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('context') != context or not isinstance(cache.get('files'), dict):
+        return {}
+    # an entry that does not look like one this verifier writes is a cache miss
+    return {name: entry for name, entry in cache['files'].items() if is_cache_entry(entry)}
+
+
+def is_cache_entry(entry) -> bool:
+    return (isinstance(entry, dict) and
+            isinstance(entry.get('size'), int) and
+            isinstance(entry.get('mtime'), int) and
+            isinstance(entry.get('sha256'), str) and
+            isinstance(entry.get('valid'), bool) and
+            isinstance(entry.get('mismatches'), list) and
+            all(isinstance(mismatch, str) for mismatch in entry['mismatches']) and
+            isinstance(entry.get('matched'), list) and
+            all(isinstance(hostname, str) for hostname in entry['matched']))
+
+
+def save_cache(dir_path: Path, context: str, files: dict):
+    # write to a temporary file first so an interrupted run never leaves a broken cache
+    temporary = dir_path / (CACHE_FILE_NAME + '.tmp')
+    try:
+        with open(temporary, 'w') as f_obj:
+            json.dump({'context': context, 'files': files}, f_obj)
+        os.replace(temporary, dir_path / CACHE_FILE_NAME)
+    except IOError:
+        # a read-only directory only means the next run starts without a cache
+        pass
+
+
+def zone_of(hostname: str) -> str:
+    # www.google.com -> google.com
+    return '.'.join(hostname.split('.')[-2:])
+
+
+class VerificationReport:
+    """
+    Every problem found while comparing the single files with the master.
+    """
+
+    def __init__(self):
+        self.invalid = []
+        self.mismatches = []
+
+    @property
+    def verdict(self) -> str:
+        if self.invalid:
+            return 'invalid single'
+        if self.mismatches:
+            return 'neq'
+        return 'eq'
+
+    def lines(self) -> list[str]:
+        # the verdict first, then one line for each problem
+        return ([self.verdict] +
+                [f'invalid single {name}' for name in sorted(self.invalid)] +
+                sorted(self.mismatches))
+
+
+def init_worker(master_record: dict, delegations: dict):
+    # give a worker process the indexes built by the parent
+    global _master_record, _delegations
+    _master_record = master_record
+    _delegations = delegations
+
+
+def check_auth_file(path: str):
+    """
+    Compare one auth file with the master and with the delegations of the TLD files.
+    Return (file name, valid, mismatches, hostnames of the master records it matches).
+    """
+    name = os.path.basename(path)
+    try:
+        record, port_of_server = parse_single_file(path)
+    except (IOError, ValueError):
+        return name, False, [], []
+
+    mismatches = []
+    matched = []
+    zones = set()
+    for domain, port in record.items():
+        expected = _master_record.get(domain)
+        if expected is None:
+            mismatches.append(f'{name}: {domain} is not in master')
+        elif expected != port:
+            mismatches.append(f'{name}: {domain} resolves to {port}, master has {expected}')
+        else:
+            matched.append(domain)
+        zones.add(zone_of(domain))
+
+    # the auth server must listen on the port its TLD delegates the zone to
+    for zone in sorted(zones):
+        delegated = _delegations.get(zone)
+        if delegated is not None and delegated != port_of_server:
+            mismatches.append(f'{name}: listens on {port_of_server}, {zone} is delegated to {delegated}')
+
+    return name, True, mismatches, matched
+
+
+def check_auth_files(paths: list[str], master_record: dict, delegations: dict, jobs: int):
+    # small directories are cheaper to check in this process
+    if jobs <= 1 or len(paths) < PARALLEL_THRESHOLD:
+        init_worker(master_record, delegations)
+        return [check_auth_file(path) for path in paths]
+
+    chunksize = max(1, len(paths) // (jobs * 8))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(master_record, delegations)) as pool:
+        return list(pool.map(check_auth_file, paths, chunksize=chunksize))
+
+
+def validate_and_compare_single_file_path(master_record: dict, file: str, jobs=None,
+                                          master_file_path=None, full=False) -> VerificationReport:
+    """
+    Compare the single files in a directory with the master record.
+    When master_file_path is given, verdicts of auth files are cached next to the single files
+    and only files whose content changed since the last run are checked again, unless full is set.
+    """
     dir_path = Path(file)
     # check existence of dir_path
     if not dir_path.is_dir():
         print('singles io error')
         sys.exit()
 
-    # try separate the path that already contains single file into each file first before read
-    list_of_file = []
-    for file in dir_path.iterdir():
-        list_of_file.append(file.name)
-    # TODO: initiate the dict
-    # Dictionary to map top-level domains
-    mapped_tld = {}
+    report = VerificationReport()
+    # sort the directory once into root, tld, auth and other configuration files
+    root_files, tld_files, auth_files, other_files = [], [], [], []
+    for entry in os.scandir(dir_path):
+        # skip the cache and other hidden files
+        if not entry.is_file() or entry.name.startswith('.'):
+            continue
+        if entry.name.startswith('root'):
+            root_files.append(entry.path)
+        elif entry.name.startswith('tld-'):
+            tld_files.append(entry.path)
+        elif entry.name.startswith('auth-'):
+            auth_files.append(entry.path)
+        else:
+            other_files.append(entry.path)
+
     # Load the root configuration file and extract the TLD-port mapping
-    with open(dir_path.joinpath('root.conf'), 'r') as f:
-        lines = f.readlines()
-    for each_line in lines[1:]:
-        parts = each_line.strip().split(',')
-        domain, port = parts
-        mapped_tld[domain] = port
-    # Validate each individual configuration file against the master record
-    for file in list_of_file:
-        # Skip the root configuration file
-        if file.startswith('root'):
+    mapped_tld = {}
+    if not root_files:
+        # launcher.py writes the root file as root-conf
+        report.invalid.append('root-conf')
+    for path in root_files:
+        try:
+            record, _ = parse_single_file(path)
+        except (IOError, ValueError):
+            report.invalid.append(os.path.basename(path))
+            continue
+        mapped_tld.update(record)
+
+    # Check every TLD file against the root and collect the zone -> auth port delegations
+    delegations = {}
+    for path in tld_files:
+        name = os.path.basename(path)
+        try:
+            record, port_of_server = parse_single_file(path)
+        except (IOError, ValueError):
+            report.invalid.append(name)
+            continue
+        tld = name[len('tld-'):].split('.')[0]
+        if mapped_tld.get(tld) != port_of_server:
+            report.mismatches.append(f'{name}: listens on {port_of_server}, root has {mapped_tld.get(tld)}')
+        for zone, port in record.items():
+            if zone.split('.')[-1] != tld:
+                report.mismatches.append(f'{name}: {zone} does not belong to {tld}')
+            delegations[zone] = port
+
+    # Every zone and TLD of the master must be reachable from the root
+    master_zones = {zone_of(domain) for domain in master_record}
+    for zone in sorted(master_zones - delegations.keys()):
+        report.mismatches.append(f'{zone} is not delegated by any TLD file')
+    for tld in sorted({zone.split('.')[-1] for zone in master_zones} - mapped_tld.keys()):
+        report.mismatches.append(f'{tld} is not delegated by the root file')
+
+    # The verdict of an auth file depends on the master, root and TLD files as well as on itself,
+    # so cached verdicts are only reused while none of those changed
+    context = None
+    cached = {}
+    if master_file_path is not None:
+        digest = hashlib.sha256(f'{CACHE_FORMAT}:{file_digest(master_file_path)}'.encode())
+        for path in sorted(root_files + tld_files):
+            digest.update(f'{os.path.basename(path)}:{file_digest(path)}'.encode())
+        context = digest.hexdigest()
+        if not full:
+            cached = load_cache(dir_path, context)
+
+    # Reuse the verdict of every auth file whose size and mtime, or failing that content, is unchanged
+    files = {}
+    to_check = []
+    for path in auth_files:
+        name = os.path.basename(path)
+        entry = cached.get(name)
+        if context is None:
+            to_check.append(path)
             continue
-        # Validate TLD configuration files
-        if file.startswith('tld'):
-            x = dir_path.joinpath(file)
-            with open(x, 'r') as f_obj:
-                lines = f_obj.readlines()
-            # Check if the TLD-port mapping matches the root configuration
-            if lines[0].strip() == mapped_tld[file.split('.')[0].strip("tld-")]:
+        try:
+            stat = os.stat(path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                files[name] = entry
                 continue
-            else:
-                print('neq')
-                sys.exit()
-        # Validate auth configuration files
-        if file.startswith('auth-'):
-            x = dir_path.joinpath(file)
-            with open(x, 'r') as f_obj:
-                lines = f_obj.readlines()
-            for each_line in lines[1:]:
-                parts = each_line.strip().split(',')
-                # Check the validity of the domain
-                if not check_hostname((parts[0])):
-                    print('invalid single')
-                    sys.exit()
-                # Ensure the port is present in the master record
-                if not parts[1] not in list(master_record.values()):
-                    print('neq')
-                    sys.exit()
-                else:
-                    continue
+            content = file_digest(path)
+        except IOError:
+            to_check.append(path)
+            continue
+        if entry and entry['sha256'] == content:
+            files[name] = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+        else:
+            files[name] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': content}
+            to_check.append(path)
+
+    # Validate the changed auth files, fanned out over a process pool for large directories
+    for name, valid, mismatches, matched in check_auth_files(to_check, master_record, delegations,
+                                                            jobs or os.cpu_count() or 1):
+        if name in files:
+            files[name].update(valid=valid, mismatches=mismatches, matched=matched)
+        else:
+            # the file could not be read, so there is nothing to cache it against
+            files[name] = {'size': -1, 'mtime': -1, 'sha256': '', 'valid': valid,
+                           'mismatches': mismatches, 'matched': matched}
+
+    # a master record is missing unless some auth file holds it with the right port
+    missing = set(master_record)
+    for name, entry in files.items():
+        if not entry['valid']:
+            report.invalid.append(name)
+        report.mismatches.extend(entry['mismatches'])
+        missing.difference_update(entry['matched'])
+    if context is not None and files != cached:
+        save_cache(dir_path, context, files)
+    for hostname in missing:
+        report.mismatches.append(f'missing {hostname}')
+
+    # Other configuration files must be well formed, and files named after TLDs like com.conf or com-org.conf
+    # must listen on the port the root gives every one of those TLDs
+    for path in other_files:
+        name = os.path.basename(path)
+        try:
+            _, port_of_server = parse_single_file(path)
+        except (IOError, ValueError):
+            report.invalid.append(name)
             continue
-        # Validate other configuration files
-        if len(file.split('.')) <= 2:
-            x = dir_path.joinpath(file)
-            with open(x, 'r') as f_obj:
-                lines = f_obj.readlines()
-            if len(file.split('.')[0].split('-')) < 2:
-                # check the port of tld server
-                if lines[0].strip() == mapped_tld[file.split('.')[0]]:
-                    continue
-                else:
-                    print('neq')
-                    sys.exit()
-            else:
-                if lines[0].strip() == mapped_tld[file.split('.')[0].split('-')[0]] and \
-                        lines[0].strip() == mapped_tld[file.split('.')[0].split('-')[1]]:
-                    continue
-                else:
-                    print('neq')
-                    sys.exit()
-        # Load and validate the configuration file
-        if not load_config_file(dir_path, file, "single"):
-            print("invalid single")
-            sys.exit()
-
-    return 'eq'
+        if len(name.split('.')) > 2:
+            continue
+        for tld in name.split('.')[0].split('-'):
+            if mapped_tld.get(tld) != port_of_server:
+                report.mismatches.append(f'{name}: listens on {port_of_server}, '
+                                         f'root has {mapped_tld.get(tld)} for {tld}')
+
+    return report
 
 
 def main(args: list[str]) -> None:
     # TODO: handling command line arguments
-    master_file_path, single_files_dir_path = validate_command_line_args(args)
+    master_file_path, single_files_dir_path, full = validate_command_line_args(args)
     # done
 
     # TODO: validate master file path
     record, port_of_server = validate_master_file(master_file_path)
     # TODO: validate 'single' file is invalid or not and compare them
 
-    print(validate_and_compare_single_file_path(record, single_files_dir_path))
+    report = validate_and_compare_single_file_path(record, single_files_dir_path,
+                                                   master_file_path=master_file_path, full=full)
+    print('\n'.join(report.lines()))
 
 
 if __name__ == "__main__":
-    main(argv[1:])
\ No newline at end of file
+    main(argv[1:])